@@ -34,76 +34,195 @@ We want to generate patient profiles which are as realistic as possible for
 # import required packages
 import pandas as pd
 import numpy as np
-import random
 import names
-from math import fsum
+import warnings
 from itertools import permutations
+from functools import lru_cache
 
 
 df = pd.read_csv('patient_perspective_data.csv')
 # remove phenotypes that do not occur
 df = df[df['probability'] != 0]
 # remove redundent phenotypes(e.g. duplicate phenotypes)
-df = df[df['discovery_group'] != 'R']
+df = df[df['discovery_group'] != 'R'].reset_index(drop=True)
+# We sample phenotypes by their row (idx) in the data and only look up their
+#  names once a patient has been generated. The same phenotype can appear in
+#  more than one row of a disorder, so we also give each name a code
+df['idx'] = np.arange(len(df))
+phenotype_names = df.patient_name.values
+name_codes = pd.factorize(df.patient_name)[0]
+# whether each row is a specific clinical finding which needs pre-requisites,
+#  and the HPO category of the pre-requisites it needs
+needs_prereq = (df.prerequisite_needed == 'Y').values
+prereq_type = df.prerequisite_type.values
+# split the data by disorder once so that patients can be generated without
+#  filtering the full dataframe every time
+disorder_groups = {disorder: group.reset_index(drop=True)
+                   for disorder, group in df.groupby('disorder', sort=False)}
+# the phenotypes which can be sampled as pre-requisites of specific clinical
+#  findings, split by disorder
+prereq_groups = {disorder: group.reset_index(drop=True)
+                 for disorder, group in df[df.prerequisite_needed == 'N']
+                 .groupby('disorder', sort=False)}
+# random number generator shared by all sampling below, set the seed to a
+#  number to generate the same datasets each time
+seed = None
+rng = np.random.default_rng(seed)
+# set to True to sample phenotypes with numba (if it is installed). This is
+#  off by default since importing numba and compiling the sampling loop takes
+#  longer than sampling the default datasets with numpy
+use_numba = False
 
 
 
+"""
+## Sampling Phenotypes for Many Patients at Once
+
+Sampling without replacement based on frequency is the same as adding Gumbel
+ noise to the log of each phenotype's probability and keeping the phenotypes
+ with the largest values, in order. This lets us draw the phenotypes for
+ every patient with a given disorder in a single call rather than one patient
+ at a time.
+If use_numba is set, we instead draw each phenotype in turn from the
+ cumulative probabilities in a compiled loop, setting the probability of each
+ drawn phenotype to zero so that it cannot be drawn again.
+"""
+
+def sample_rows_loop(rng, p, sizes, max_size):
+    top = np.zeros((sizes.shape[0], max_size), dtype=np.int64)
+    for i in range(sizes.shape[0]):
+        weights = p.copy()
+        for j in range(sizes[i]):
+            cum_p = np.cumsum(weights)
+            chosen = np.searchsorted(cum_p, rng.random()*cum_p[-1],
+                                     side='right')
+            # rounding can place the draw at the very end of cum_p, in which
+            #  case we take the last phenotype not yet drawn
+            if chosen == len(weights):
+                chosen -= 1
+            while weights[chosen] == 0:
+                chosen -= 1
+            top[i, j] = chosen
+            weights[chosen] = 0
+    return top
+
+# The compiled loop, or None to sample with numpy
+sample_rows = None
+if use_numba:
+    try:
+        from numba import njit
+        from numba.core.errors import NumbaError
+        sample_rows = njit(sample_rows_loop)
+    except ImportError:
+        pass
+
+
+def weighted_sample(p, sizes):
+    global sample_rows
+    # A negative size would slice from the end of a patient's sample, so we
+    #  raise an error as np.random.choice would
+    if sizes.min(initial=0) < 0:
+        raise ValueError('sample sizes must be non-negative')
+    # An empty numpy array is identity under concatination, so patients
+    #  who are assigned no phenotypes get an empty sample
+    max_size = sizes.max(initial=0)
+    if max_size <= 0:
+        return [np.empty((0,), dtype=int) for size in sizes]
+    top = None
+    if sample_rows is not None:
+        try:
+            top = sample_rows(rng, p, sizes, max_size)
+        except NumbaError as error:
+            # if numba cannot compile the loop we sample with numpy instead
+            warnings.warn('numba could not compile the sampling loop, '
+                          'sampling with numpy instead: %s' % error)
+            sample_rows = None
+    if top is None:
+        # Each row holds one patient's perturbed log probabilities
+        keys = np.log(p) + rng.gumbel(size=(len(sizes), len(p)))
+        # We only need to order the largest max_size keys of each row, since
+        #  the first keys in this order are the sample for every smaller size
+        top = np.argpartition(-keys, max_size - 1, axis=1)[:, :max_size]
+        order = np.argsort(-np.take_along_axis(keys, top, axis=1), axis=1)
+        top = np.take_along_axis(top, order, axis=1)
+    return [row[:size] for row, size in zip(top, sizes)]
+
 """
 ## Normalising The Data for a Given Category
 
-In order to use np.random.choice, we need to normalise the phenotype frequency.
+In order to sample phenotypes, we need to normalise the phenotype frequency.
 So, let us define a function which normalises the data for each of the four
  categories of phenotypes for a given disorder.
 This enables us to generate the phenotypes separately to control the order.
-We do this by taking a column name and desired value as inputs so that we pick a
- subset of all data where `column=specified_val` based on the frequency of these
- symptoms occuring within said disorder.
+We do this by taking a column name and desired value as inputs so that we pick
+ from a subset of all data where `column=specified_val` based on the
+ frequency of these symptoms occuring within said disorder.
+We return one array of phenotype rows for each patient, given the noise to
+ apply to the number of phenotypes sampled for each patient.
+
+The subset for a given disorder, column and value is the same for every
+ patient, so we only find its rows, normalised probabilities and weight
+ within the disorder once.
 """
 
-def phenotype_choice(df,
-                     disorder_name: str,
+@lru_cache(maxsize=None)
+def phenotype_subset(disorder_name: str,
                      column_name:str,
                      column_value:str,
-                     total_phenotypes:int):
-    # Reduce data to inputted disorder and reset index to prevent indexing
-    #  errors
-    current_disorder = df[df.disorder == disorder_name].reset_index(drop=True)
+                     prerequisites:bool=False):
+    # Reduce data to inputted disorder, or to the phenotypes of the disorder
+    #  which can be sampled as pre-requisites
+    if prerequisites:
+        current_disorder = prereq_groups[disorder_name]
+    else:
+        current_disorder = disorder_groups[disorder_name]
     # Reducing data to a specific attribute so that a column = attribute
     #  (e.g. if column=Label columnVal=F would reduce data to clinical
     #  findings)
     current_discovery_grp = current_disorder[current_disorder[column_name]
                                           == column_value]
-    # We take the list of phenotypes
-    a = current_discovery_grp.patient_name
-    # We take the probability of each phenotype
-    p = current_discovery_grp.probability
+    p = current_discovery_grp.probability.values
+    subset_total = p.sum()
+    # The weight of the subset of phenotypes within the disorder
+    subset_weight = subset_total/current_disorder.probability.sum()
+    return(current_discovery_grp.idx.values, p/subset_total, subset_weight)
+
+
+def phenotype_choice(disorder_name: str,
+                     column_name:str,
+                     column_value:str,
+                     total_phenotypes:int,
+                     noise_factor,
+                     prerequisites:bool=False):
+    # We take the rows of the phenotypes, the normalised probability of each
+    #  phenotype and the weight of the subset
+    a, p, subset_weight = phenotype_subset(disorder_name,
+                                           column_name,
+                                           column_value,
+                                           prerequisites)
+    # An empty numpy array is identity under concatination to allow for
+    # disorders with no phenotypes of a given disorder group, so we return
+    # these before working out how many phenotypes to sample
+    if len(a) == 0:
+        return [np.empty((0,), dtype=int) for noise in noise_factor]
     # We change the number of phenotypes sampled (size) to be representative
     #  of the weight of the subset of phenotypes
-    subset_weight = fsum(p)/fsum(current_disorder.probability)
     size = total_phenotypes*subset_weight
     # Since the number of each type of phenotype will vary from patient to
-    #  patient, we add noise to change how many phenotypes are generated and
-    #  then round to an integer
-    size = round(np.random.normal(size, size*0.15))
-    # An empty numpy array is identity under concatination to allow for
-    # disorders with no phenotypes of a given disorder group
-    if len(a) == 0:
-        phenotypes = np.empty((0,))
-    else:
-        if len(a)<size:
-            size = round(len(a)*0.8)
-        # sample phenotypes based on normalised probability
-        phenotypes = np.random.choice(a,
-                                      size=size,
-                                      replace=False,
-                                      p=p/fsum(p))
-    return(phenotypes)
+    #  patient, we scale the size by the noise given for each patient to
+    #  change how many phenotypes are generated and then round to an integer.
+    #  We can sample at least no phenotypes and at most all phenotypes in the
+    #  subset
+    sizes = np.clip(np.rint(size*noise_factor).astype(int), 0, len(a))
+    # sample phenotypes based on normalised probability
+    samples = weighted_sample(p, sizes)
+    return [a[sample] for sample in samples]
 
 """
-## Generating Patient Profiles for a Single Patient
+## Generating Patient Profiles
 
 Here we use phenotypeChoice to generate clinical findings, symptoms and
- developmental traits.
+ developmental traits, for all patients with a given disorder at once.
 
 For clinical findings that would only usually be identified through specific
  investigations, we find symptoms that would prompt these investigations.
@@ -112,62 +231,75 @@ We do this by identifying the clinical findings which require prior symptoms
  symptoms relating to the finding - may need to change this).
 """
 
-def generate_single_patient(disorder: str, total_phenotypes:int, patient_info):
+def generate_patients(disorder: str, total_phenotypes:int, patient_info:list):
+    # We generate one patient for each entry of patient information, drawing
+    #  the noise in how many findings, symptoms and developmental traits each
+    #  patient has all at once
+    noise = rng.normal(1.0, 0.15, size=(len(patient_info), 3))
     # Generating findings, symptoms and developmental traits
-    fin = phenotype_choice(df,
-                           disorder,
+    fin = phenotype_choice(disorder,
                            'discovery_group',
                            'F',
-                           total_phenotypes)
-    sym = phenotype_choice(df,
-                           disorder,
+                           total_phenotypes,
+                           noise[:, 0])
+    sym = phenotype_choice(disorder,
                            'discovery_group',
                            'S',
-                           total_phenotypes)
-    dev = phenotype_choice(df,
-                           disorder,
+                           total_phenotypes,
+                           noise[:, 1])
+    dev = phenotype_choice(disorder,
                            'discovery_group',
                            'D',
-                           total_phenotypes)
+                           total_phenotypes,
+                           noise[:, 2])
+    return [complete_patient(disorder, total_phenotypes, info,
+                             fin[i], sym[i], dev[i])
+            for i, info in enumerate(patient_info)]
+
+
+def complete_patient(disorder: str, total_phenotypes:int, patient_info,
+                     fin, sym, dev):
     # Find data for all clinical findings that would only usually be
     #  identified through specific investigations so that we can generate
-    #  symptoms/findings that would promt these investigations
-    current_disorder = df[df.disorder == disorder].reset_index(drop=True)
-    fin_array = current_disorder[current_disorder.patient_name.isin(fin)]
-    specific_fin = fin_array[fin_array.prerequisite_needed == 'Y']
+    #  symptoms/findings that would promt these investigations. Since fin
+    #  holds the rows of the findings, we can look them up directly
+    specific_fin = fin[needs_prereq[fin]]
     # Each of these findings have pre-requisites listed in the
-    specific_fin = specific_fin.prerequisite_type
-    # An empty dataframe is identity under concatination, so we can
-    # concatinate the dataframe for each finding with pre-requisites
-    sampled_prereq_list = np.empty((0,))
+    #  prerequisite_type column
+    specific_fin = prereq_type[specific_fin]
+    # We collect the pre-requisites for every finding in a list and convert
+    #  it to an array once all findings have been considered
+    sampled_prereq_list = []
     if specific_fin.shape != (0,):
-        for finding in specific_fin:
+        # The phenotypes the patient already has, so that each pre-requisite
+        #  is only added once
+        existing = (set(name_codes[sym].tolist())
+                    | set(name_codes[dev].tolist()))
+        prereq_noise = rng.normal(1.0, 0.15, size=(len(specific_fin), 1))
+        for finding, noise_factor in zip(specific_fin, prereq_noise):
             # we select phenotypes which relate to the findings
-            prereq_df = df[df.prerequisite_needed == 'N']
-            prereq_finding = phenotype_choice(prereq_df,
-                                             disorder,
-                                             'HPO_category',
-                                             finding,
-                                             total_phenotypes)
+            prereq_finding = phenotype_choice(disorder,
+                                              'HPO_category',
+                                              finding,
+                                              total_phenotypes,
+                                              noise_factor,
+                                              prerequisites=True)[0]
             # We concatinate each list of pre-requisites (for different
             #  specific findings) into one list if it is not in the current
             #  list of symptoms or developmental traits
             for sampled_prereq in prereq_finding:
-                if np.isin(np.hstack((sym,dev)),
-                           sampled_prereq).any == False:
-                    sampled_prereq_list = np.hstack((sampled_prereq_list,
-                                                     sampled_prereq))
-        if sym.shape != (0,):
-            sym = np.hstack((sym, sampled_prereq_list))
-        else:
-            sym = sampled_prereq_list
+                if name_codes[sampled_prereq] not in existing:
+                    existing.add(name_codes[sampled_prereq])
+                    sampled_prereq_list.append(sampled_prereq)
+        sym = np.concatenate((sym, np.asarray(sampled_prereq_list,
+                                              dtype=int)))
     # We concatinate all phenotypes ordering them to how they should be
     #  displayed to the user, since developmental traits would naturally
-    #  occur first followed by symptoms, followed by clinical findings
-    phenotypes = np.hstack((dev, sym, fin))
-    # Concatinate patient information for lab study or for peer matching
-
-    phenotypes = np.append(patient_info, phenotypes)
+    #  occur first followed by symptoms, followed by clinical findings,
+    #  after the patient information for lab study or for peer matching
+    phenotypes = phenotype_names[np.concatenate((dev, sym, fin))]
+    phenotypes = np.concatenate((np.asarray(patient_info, dtype=object),
+                                 phenotypes))
     return(phenotypes)
 
 
@@ -177,72 +309,121 @@ def generate_timeseries_personas(disorder_list: list,
                                   total_phenotypes:int,
                                   total_participants:int):
     # add noise to vary the number of phenotypes sampled per user
-    total_phenotypes = round(np.random.normal(total_phenotypes,
-                                              total_phenotypes*0.1))
-    # An empty dataframe is identity under concatination, so we can
-    #  concatinate the dataframe for each game
-    games = pd.DataFrame()
+    total_phenotypes = round(rng.normal(total_phenotypes,
+                                        total_phenotypes*0.1))
+    # We collect a row for each game and build the dataframe once all games
+    #  have been generated
+    games = []
+    # We generate the patient cases of every participant for each entry of
+    #  disorder_list at once, with no patient information added to the
+    #  phenotypes. The batches are kept in the order of disorder_list so that
+    #  a disorder listed more than once gets a separate case each time
+    disorder_games = [generate_patients(disorder,
+                                        total_phenotypes,
+                                        [[]]*total_participants)
+                      for disorder in disorder_list]
+    website_orders = list(permutations([0,1,2]))
     # Generate games for a given number of participants
     for i in range(0,total_participants):
         j=(i+1)%5
-        website_choices = list(permutations([0,1,2]))[j]
+        website_choices = website_orders[j]
         # 0: peer matching, 1: maladyHelp, 2: Google custom
         # Each participant should play the game three times for each
         #  disorder, so we number the games using n
         n=0
         for disorder in disorder_list:
-            # Here we create a dataframe showing participant ID, game ID,
-            #  and a random name for their patient case
-            patient_info = pd.DataFrame()
-            single_game = generate_single_patient(disorder,
-                                                  total_phenotypes,
-                                                  patient_info)
-            round1, round2, round3 = np.array_split(single_game, 3)
-            patient_info = pd.DataFrame([i, n, disorder, website_choices[n]])
+            single_game = disorder_games[n][i]
+            # We split the phenotypes into three rounds, with the earlier
+            #  rounds taking any extra phenotypes (as in np.array_split)
+            total = len(single_game)
+            split1 = -(-total//3)
+            split2 = -(-2*total//3)
+            # Here we record the participant ID, game ID, disorder and
+            #  website used for their patient case
+            patient_info = [i, n, disorder, website_choices[n]]
             n+=1
             # Join the array of phenotypes into a single string of
             #  phenotypes for each round, separated with a comma
-            round1 = ", ".join(round1)
-            round2 = ", ".join(round2)
-            round3 = ", ".join(round3)
-            rounds = pd.DataFrame([round1,round2,round3])
-            game = pd.concat([patient_info, rounds])
-            games = pd.concat([games, game], axis=1)
-    # we transpose the dataframe for readability
-    games = games.T.reset_index(drop=True)
-    games.columns=['participant_ID', 'game_ID', 'disorder',
-                   'website_choice', 'round_1', 'round_2', 'round_3']
+            round1 = ", ".join(single_game[:split1])
+            round2 = ", ".join(single_game[split1:split2])
+            round3 = ", ".join(single_game[split2:])
+            games.append(patient_info + [round1, round2, round3])
+    games = pd.DataFrame(games,
+                         columns=['participant_ID', 'game_ID', 'disorder',
+                                  'website_choice', 'round_1', 'round_2',
+                                  'round_3'])
     return(games)
 
 
 
 ## Generating Users for Peer Matching Algorithm
 
+# names.get_first_name reads through a file of names every time it is called,
+#  so we read the male and female first names and their cumulative
+#  frequencies once and sample names for all users together. The empty name
+#  at the end matches get_first_name when no name is selected
+def read_first_names(filename):
+    with open(filename) as name_file:
+        rows = [line.split() for line in name_file]
+    first_names = np.array([row[0].capitalize() for row in rows] + [''],
+                           dtype=object)
+    cummulative = np.array([float(row[2]) for row in rows])
+    return(first_names, cummulative)
+
+first_name_dists = [read_first_names(names.FILES['first:male']),
+                    read_first_names(names.FILES['first:female'])]
+
+
+def sample_first_names(total_names:int):
+    # pick male or female names with equal chance, then pick the first name
+    #  with a cumulative frequency above the selected value
+    genders = rng.integers(0, 2, total_names)
+    selected = rng.random(total_names)*90
+    name_pool = np.empty(total_names, dtype=object)
+    for gender, (first_names, cummulative) in enumerate(first_name_dists):
+        chosen = genders == gender
+        name_pool[chosen] = first_names[np.searchsorted(cummulative,
+                                                        selected[chosen],
+                                                        side='right')]
+    return(name_pool)
+
+
 def generate_users(disorder_list: list,
                    total_phenotypes:int,
                    users_per_disorder:int):
-    # An empty dataframe is identity under concatination, so we can
-    #  concatinate the dataframe for each user
-    users = pd.DataFrame()
-    # generate a given number of disorders
-    for i in range(0,users_per_disorder):
-        # currently generates an equal number of users per disorder
-        for disorder in disorder_list:
-            # We want the majority of users (currently set to 80%) in the
-            #  matching algorithm to be undiagnosed
-            k = random.randint(1, 10)
+    # We collect a row for each user and build the dataframe once all users
+    #  have been generated
+    users = []
+    max_len = 0
+    # We generate all the users for each entry of disorder_list at once,
+    #  keeping track of how far along in their diagnosis each user is (k).
+    #  The batches are kept in the order of disorder_list so that a disorder
+    #  listed more than once gets a separate batch of users each time
+    stages = []
+    disorder_users = []
+    # We sample a name for every user at once
+    name_pool = iter(sample_first_names(users_per_disorder*len(disorder_list)))
+    for disorder in disorder_list:
+        # We want the majority of users (currently set to 80%) in the
+        #  matching algorithm to be undiagnosed
+        stages.append(rng.integers(1, 11, users_per_disorder))
+        patient_info = []
+        for k in stages[-1]:
             if k>2:
                 # We assign users names and diagnosis status
-                patient_info = pd.DataFrame([names.get_first_name(),
-                                             'undiagnosed'])
+                patient_info.append([next(name_pool), 'undiagnosed'])
             else:
                 # We assign users names and diagnosis
-                patient_info = pd.DataFrame([names.get_first_name(),
-                                             disorder])
-            # Generate single user
-            user = generate_single_patient(disorder,
-                                           total_phenotypes,
-                                           patient_info)
+                patient_info.append([next(name_pool), disorder])
+        disorder_users.append(generate_patients(disorder,
+                                                total_phenotypes,
+                                                patient_info))
+    # generate a given number of disorders
+    for i in range(0,users_per_disorder):
+        # currently generates an equal number of users per disorder
+        for pos in range(len(disorder_list)):
+            k = stages[pos][i]
+            user = disorder_users[pos][i]
             # We remove the end phenotypes for users at an earlier stage
             #  of diagnosis
             phenotypes = len(user)
@@ -250,13 +431,15 @@ def generate_users(disorder_list: list,
                 user = user[0:round(phenotypes*0.75)]
             elif k>4:
                 user = user[0:round(phenotypes*0.85)]
-            user = pd.DataFrame(user)
-            # Concatinate to one dataframe
-            users = pd.concat([users, user], axis=1)
-    # we transpose the dataframe for readability
-    users = users.T.reset_index(drop=True)
-    # removing empty columns resulting from our removal of phenotypes
-    users = users.dropna(how='all')
+            users.append(user)
+            max_len = max(max_len, len(user))
+    # users with fewer phenotypes are padded with NaN to the length of the
+    #  longest user, so we fill one array with every user before building
+    #  the dataframe
+    user_matrix = np.full((len(users), max_len), np.nan, dtype=object)
+    for row, user in enumerate(users):
+        user_matrix[row, :len(user)] = user
+    users = pd.DataFrame(user_matrix)
     return(users)
 
 